@@ -1,8 +1,12 @@
+import asyncio
 import subprocess
 import inspect
 import tempfile
 import copy
+import hashlib
 import importlib.metadata
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from itertools import chain
 import json
 import os
@@ -11,13 +15,14 @@ import shutil
 import sys
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Dict, Iterable, List, Optional
+from types import MappingProxyType
+from typing import Any, AsyncGenerator, Dict, Iterable, List, Optional, Tuple
+from weakref import WeakKeyDictionary
 import subprocess as sp
 import shlex
 
 import httpx
 import yaml
-import aiofiles
 
 from snakemake_interface_common.exceptions import WorkflowError
 from snakemake_interface_software_deployment_plugins.settings import (
@@ -42,11 +47,36 @@ from snakemake_software_deployment_plugin_conda.pinfiles import (
     get_match_specs_from_conda_pinfile,
 )
 
+try:
+    # use the libyaml based loader if pyyaml has been built with it
+    from yaml import CSafeLoader as YamlSafeLoader
+except ImportError:
+    from yaml import SafeLoader as YamlSafeLoader
+
 
 __version__ = importlib.metadata.version("snakemake-software-deployment-plugin-conda")
 
 
-PINFILE_SUFFIX = f".{Platform.current()}.pin.txt"
+# The platform cannot change while we are running, hence determine it only once.
+CURRENT_PLATFORM = Platform.current()
+PINFILE_SUFFIX = f".{CURRENT_PLATFORM}.pin.txt"
+
+# Upper bound for the number of package downloads that run at the same time
+# (across all environments).
+MAX_CONCURRENT_DOWNLOADS = 8
+# Size of the chunks in which downloaded packages are written to disk.
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+
+# Shell executables (by name) supported for activating environments.
+RATTLER_SHELLS = MappingProxyType(
+    {
+        "bash": Shell.bash,
+        "zsh": Shell.zsh,
+        "xonsh": Shell.xonsh,
+        "fish": Shell.fish,
+    }
+)
 
 
 common_settings = CommonSettings(
@@ -105,8 +135,22 @@ class Env(PinnableEnvBase, CacheableEnvBase, DeployableEnvBase, EnvBase):
     def __post_init__(self):
         self._package_records_cache: Optional[List[RepoDataRecord]] = None
         self._envfile_content = None
+        self._envfile_hash_input: Optional[bytes] = None
+        self._dependencies: Optional[Tuple[List[str], List[str]]] = None
         self._cache_assets = None
         self._containerized_path = None
+        self._named_env_prefix: Optional[Path] = None
+        self._pickled_for_within: Optional[Tuple[str, bytes]] = None
+        self._activation_scripts: Dict[Tuple[Path, str], str] = {}
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        # Drop caches that cannot be pickled (rattler records) or that are
+        # meaningless in another process.
+        state["_package_records_cache"] = None
+        state["_cache_assets"] = None
+        state["_pickled_for_within"] = None
+        return state
 
     @property
     def containerized_path(self) -> Optional[Path]:
@@ -115,6 +159,7 @@ class Env(PinnableEnvBase, CacheableEnvBase, DeployableEnvBase, EnvBase):
     @containerized_path.setter
     def containerized_path(self, value: Optional[Path]) -> None:
         self._containerized_path = value
+        self._pickled_for_within = None
         self.clear_hashes()
 
     def is_cacheable(self) -> bool:
@@ -129,34 +174,41 @@ class Env(PinnableEnvBase, CacheableEnvBase, DeployableEnvBase, EnvBase):
     @property
     def rattler_shell(self) -> Shell:
         shell_executable = self.shell_executable.name
-
-        if shell_executable == "bash":
-            return Shell.bash
-        elif shell_executable == "zsh":
-            return Shell.zsh
-        elif shell_executable == "xonsh":
-            return Shell.xonsh
-        elif shell_executable == "fish":
-            return Shell.fish
-        else:
+        try:
+            return RATTLER_SHELLS[shell_executable]
+        except KeyError:
             raise WorkflowError(
                 "Unsupported shell executable for "
                 f"snakemake-software-deployment-plugin-conda: {shell_executable}"
-            )
+            ) from None
 
+    # EnvBase.once caches per plugin class and "within" environment, i.e. the
+    # clients below are queried only once per process, not once per Env.
     @EnvBase.once
     def conda_env_directories(self) -> List[Path]:
+        clients = ("micromamba", "conda", "mamba")
+
+        def query_info(client: str) -> sp.CompletedProcess:
+            return self.run_cmd(
+                f"{client} info --json",
+                stderr=sp.STDOUT,
+                stdout=sp.PIPE,
+                check=True,
+            )
+
+        # The clients are independent of each other, hence query them
+        # concurrently. Results are still evaluated in the order above.
+        with ThreadPoolExecutor(max_workers=len(clients)) as executor:
+            queries = {
+                client: executor.submit(query_info, client) for client in clients
+            }
+
         errors = {}
         success = False
         dirs = []
-        for client in ("micromamba", "conda", "mamba"):
+        for client, query in queries.items():
             try:
-                output = self.run_cmd(
-                    f"{client} info --json",
-                    stderr=sp.STDOUT,
-                    stdout=sp.PIPE,
-                    check=True,
-                )
+                output = query.result()
             except sp.CalledProcessError as e:
                 errors[client] = f"Failed to run {client}: {e}"
                 continue
@@ -186,15 +238,24 @@ class Env(PinnableEnvBase, CacheableEnvBase, DeployableEnvBase, EnvBase):
             return self.deployment_path
         elif self.spec.directory is not None:
             return self.spec.directory
+        elif self._named_env_prefix is not None:
+            return self._named_env_prefix
         else:
             assert self.spec.name is not None
-            candidates = {
-                env_dir / self.spec.name
-                for env_dir in self.conda_env_directories()
-                if (env_dir / self.spec.name).is_dir()
-            }
+            candidates = []
+            # Env directories reported by multiple clients are checked only once.
+            # A second match already makes the name ambiguous, hence stop there.
+            for env_dir in dict.fromkeys(self.conda_env_directories()):
+                candidate = env_dir / self.spec.name
+                if candidate.is_dir():
+                    candidates.append(candidate)
+                    if len(candidates) > 1:
+                        break
             if len(candidates) == 1:
-                return next(iter(candidates))
+                # Remember the location, such that activating the environment for
+                # further commands does not scan the env directories again.
+                self._named_env_prefix = candidates[0]
+                return self._named_env_prefix
             elif len(candidates) > 1:
                 raise WorkflowError(
                     f"Multiple environments found with name {self.spec.name}: "
@@ -210,7 +271,7 @@ class Env(PinnableEnvBase, CacheableEnvBase, DeployableEnvBase, EnvBase):
             assert self.spec.envfile.cached is not None
             try:
                 with open(self.spec.envfile.cached, "r") as f:
-                    self._envfile_content = yaml.load(f, Loader=yaml.SafeLoader)
+                    self._envfile_content = yaml.load(f, Loader=YamlSafeLoader)
             except Exception as e:
                 raise WorkflowError(
                     f"Could not read envfile {self.spec.envfile.path_or_uri}",
@@ -224,12 +285,19 @@ class Env(PinnableEnvBase, CacheableEnvBase, DeployableEnvBase, EnvBase):
         # Pass an absolute path to the environment prefix.
         # This is important to ensure that processes within the environment that
         # change the working directory can still properly resolve the PATH.
-        act_obj = activate(
-            prefix=self.env_prefix().absolute(),
-            activation_variables=ActivationVariables(None, sys.path),
-            shell=self.rattler_shell,
-        )
-        act = act_obj.script.strip().replace("\n", "; ")
+        prefix = self.env_prefix().absolute()
+        # The activation script only depends on prefix and shell, hence generate
+        # it once and reuse it for all further commands.
+        key = (prefix, self.shell_executable.name)
+        act = self._activation_scripts.get(key)
+        if act is None:
+            act_obj = activate(
+                prefix=prefix,
+                activation_variables=ActivationVariables(None, sys.path),
+                shell=self.rattler_shell,
+            )
+            act = act_obj.script.strip().replace("\n", "; ")
+            self._activation_scripts[key] = act
         return f"{act}; {cmd}"
 
     def contains_executable(self, executable: str) -> bool:
@@ -242,9 +310,11 @@ class Env(PinnableEnvBase, CacheableEnvBase, DeployableEnvBase, EnvBase):
         if self.spec.envfile is not None:
             # TODO add deploy script content (and support deploy script in general!)
             # TODO add pinfile content
-            hash_object.update(
-                json.dumps(self.envfile_content, sort_keys=True).encode()
-            )
+            if self._envfile_hash_input is None:
+                self._envfile_hash_input = json.dumps(
+                    self.envfile_content, sort_keys=True
+                ).encode()
+            hash_object.update(self._envfile_hash_input)
         elif self.spec.directory is not None:
             hash_object.update(str(self.spec.directory).encode())
         else:
@@ -261,37 +331,45 @@ class Env(PinnableEnvBase, CacheableEnvBase, DeployableEnvBase, EnvBase):
         # Return an empty list if no software can be reported.
         assert isinstance(self.spec, EnvSpec)
         if self.spec.envfile is not None:
-
-            def entry_to_report(entry):
-                entry = MatchSpec(entry)
-                assert entry.name is not None
-                return SoftwareReport(
-                    name=entry.name.normalized,
-                    version=entry.version,
+            reports = []
+            for entry in chain(self.conda_specs, self.pypi_specs):
+                spec = MatchSpec(entry)
+                name = spec.name
+                assert name is not None
+                reports.append(
+                    SoftwareReport(name=name.normalized, version=spec.version)
                 )
-
-            return list(map(entry_to_report, chain(self.conda_specs, self.pypi_specs)))
+            return reports
         else:
             # TODD dynamically obtain software list from the deployed environment
             return ()
 
     @property
     def conda_specs(self) -> List[str]:
-        return [
-            spec
-            for spec in self.envfile_content["dependencies"]
-            if not isinstance(spec, dict)
-        ]
+        return self._split_dependencies()[0]
 
     @property
     def pypi_specs(self) -> List[str]:
-        for spec in self.envfile_content["dependencies"]:
-            if isinstance(spec, dict):
-                pypi_specs = spec["pip"]
-                if not isinstance(pypi_specs, list):
-                    raise WorkflowError("pypi/pip dependencies must be a list")
-                return spec["pip"]
-        return []
+        return self._split_dependencies()[1]
+
+    def _split_dependencies(self) -> Tuple[List[str], List[str]]:
+        # Partition the dependencies into conda and pypi specs in a single pass.
+        if self._dependencies is None:
+            conda_specs = []
+            pypi_specs = None
+            for spec in self.envfile_content["dependencies"]:
+                if isinstance(spec, dict):
+                    if pypi_specs is None:
+                        pypi_specs = spec["pip"]
+                        if not isinstance(pypi_specs, list):
+                            raise WorkflowError("pypi/pip dependencies must be a list")
+                else:
+                    conda_specs.append(spec)
+            self._dependencies = (
+                conda_specs,
+                pypi_specs if pypi_specs is not None else [],
+            )
+        return self._dependencies
 
     def _platforms(self) -> List[Platform]:
         if self.within is not None:
@@ -302,11 +380,12 @@ class Env(PinnableEnvBase, CacheableEnvBase, DeployableEnvBase, EnvBase):
                 )
             ]
 
-        return [Platform.current(), Platform("noarch")]
+        return [CURRENT_PLATFORM, Platform("noarch")]
 
     def channels(self, platforms: List[Platform]) -> List[str]:
         is_win = any(p.is_windows for p in platforms)
-        channels = self.envfile_content.get("channels", [])
+        # copy, such that the cached envfile content is not modified below
+        channels = list(self.envfile_content.get("channels", []))
         try:
             defaults_idx = channels.index("defaults")
             channels.remove("defaults")
@@ -336,10 +415,9 @@ class Env(PinnableEnvBase, CacheableEnvBase, DeployableEnvBase, EnvBase):
             channels = self.channels(platforms)
 
             if pinfile.exists():
-                gateway = Gateway()
                 records = list(
                     chain.from_iterable(
-                        await gateway.query(
+                        await shared_gateway().query(
                             sources=channels,
                             platforms=platforms,
                             specs=list(get_match_specs_from_conda_pinfile(pinfile)),
@@ -354,8 +432,9 @@ class Env(PinnableEnvBase, CacheableEnvBase, DeployableEnvBase, EnvBase):
                         sources=channels,
                         # The specs to solve for
                         specs=self.conda_specs,
+                        gateway=shared_gateway(),
                         # Virtual packages define the specifications of the environment
-                        virtual_packages=VirtualPackage.detect(),
+                        virtual_packages=detect_virtual_packages(),
                         platforms=platforms,
                     )
                 )
@@ -367,10 +446,9 @@ class Env(PinnableEnvBase, CacheableEnvBase, DeployableEnvBase, EnvBase):
 
     async def pin(self) -> None:
         records = await self._package_records()
-        async with aiofiles.open(self.pinfile, "w") as f:
-            await f.write("@EXPLICIT\n")
-            for record in records:
-                await f.write(f"{record.url}\n")
+        # Assemble the whole pinfile first and write it in a single call.
+        lines = ["@EXPLICIT", *(record.url for record in records)]
+        await asyncio.to_thread(self.pinfile.write_text, "\n".join(lines) + "\n")
 
     async def get_cache_assets(self) -> Iterable[str]:
         if self._cache_assets is None:
@@ -386,12 +464,53 @@ class Env(PinnableEnvBase, CacheableEnvBase, DeployableEnvBase, EnvBase):
         )
         record = self._cache_assets[asset]
 
-        async with httpx.AsyncClient() as http_client:
-            response = await http_client.get(record.url)
+        # Prefer sha256, but fall back to md5 for records that only provide the
+        # latter.
+        if record.sha256 is not None:
+            algorithm, expected = "sha256", record.sha256
+        else:
+            algorithm, expected = "md5", record.md5
+
+        cached = self.get_cache_asset_path(asset)
+        if (
+            expected is not None
+            and cached.exists()
+            and await asyncio.to_thread(file_digest, cached, algorithm) == expected
+        ):
+            # The package is already present and intact, no need to download it
+            # again. Moving it is enough, since managed_cache_asset moves it back
+            # afterwards.
+            await asyncio.to_thread(os.replace, cached, to_path)
+            return
+
+        checksum = hashlib.new(algorithm)
+        session = await download_session()
+        async with (
+            session.slots,
+            # Packages are already compressed, hence we request them as is and
+            # write the raw bytes without any decoding.
+            session.http_client.stream(
+                "GET", record.url, headers={"Accept-Encoding": "identity"}
+            ) as response,
+        ):
             response.raise_for_status()
-            async with aiofiles.open(to_path, "wb") as f:
-                async for chunk in response.aiter_bytes(chunk_size=1024):
-                    await f.write(chunk)
+            # Chunks are large, hence write each of them with a single hop to
+            # a worker thread.
+            with open(to_path, "wb") as f:
+
+                def write_chunk(chunk: bytes) -> None:
+                    f.write(chunk)
+                    checksum.update(chunk)
+
+                async for chunk in response.aiter_raw(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    await asyncio.to_thread(write_chunk, chunk)
+
+        if expected is not None and checksum.digest() != expected:
+            raise WorkflowError(
+                f"Checksum mismatch for downloaded package {record.url}: "
+                f"expected {algorithm} {expected.hex()}, "
+                f"got {checksum.hexdigest()}."
+            )
 
     def _run_method(
         self, name: str, *args: Any, mod_pattern: Optional[str] = None, **kwargs: Any
@@ -402,20 +521,29 @@ class Env(PinnableEnvBase, CacheableEnvBase, DeployableEnvBase, EnvBase):
 
         # ensure that deployment_hash is calculated and cached such that
         # the same hash is used inside of the "within" environment
-        self.deployment_hash()
-
-        # create a copy of the environment
-        self_copy = copy.copy(self)
-        # Unset within such that really only this env is instantiated within.
-        # The hash will remain unchanged, as it is already computed and cached.
-        self_copy.within = None
-        # Unset _package_records_cache since it cannot be pickled.
-        self_copy._package_records_cache = None
-        self_copy._cache_assets = None
-        assert self_copy._managed_deployment_hash_store is not None
-
-        # pickle the environment object for reuse inside of the "within" environment
-        pickled = pickle.dumps(self_copy)
+        deployment_hash = self.deployment_hash()
+
+        # The pickled environment only changes along with the deployment hash,
+        # hence reuse it for subsequent invocations.
+        if (
+            self._pickled_for_within is None
+            or self._pickled_for_within[0] != deployment_hash
+        ):
+            # create a copy of the environment (without the unpicklable caches,
+            # see __getstate__)
+            self_copy = copy.copy(self)
+            # Unset within such that really only this env is instantiated within.
+            # The hash will remain unchanged, as it is already computed and cached.
+            self_copy.within = None
+            assert self_copy._managed_deployment_hash_store is not None
+
+            # pickle the environment object for reuse inside of the "within"
+            # environment
+            self._pickled_for_within = (
+                deployment_hash,
+                pickle.dumps(self_copy, protocol=pickle.HIGHEST_PROTOCOL),
+            )
+        pickled = self._pickled_for_within[1]
         fmt_args = ",".join(map(repr, args))
         if kwargs:
             fmt_args += "," + ",".join(f"{kw}={arg!r}" for kw, arg in kwargs.items())
@@ -489,11 +617,15 @@ class Env(PinnableEnvBase, CacheableEnvBase, DeployableEnvBase, EnvBase):
 
         pypi_specs = [spec.replace(" ", "") for spec in self.pypi_specs]
         if pypi_specs:
-            self._deploy_pypi_specs(pypi_specs)
+            await self._deploy_pypi_specs(pypi_specs)
 
-    def _deploy_pypi_specs(self, pypi_specs: List[str]) -> None:
+    async def _deploy_pypi_specs(self, pypi_specs: List[str]) -> None:
         if self.within is not None:
-            return self._run_method("_deploy_pypi_specs", pypi_specs)
+            # Running the method within the parent environment blocks until it
+            # is done, hence keep it off the event loop.
+            return await asyncio.to_thread(
+                self._run_method, "_deploy_pypi_specs", pypi_specs
+            )
 
         def raise_python_error(errmsg: str):
             raise WorkflowError(
@@ -508,24 +640,32 @@ class Env(PinnableEnvBase, CacheableEnvBase, DeployableEnvBase, EnvBase):
                 f"No python found under {self.deployment_path}. If your environment contains pypi packages, please add python to the non-pypi packages list."
             )
 
-        try:
-            sp.run(
-                [
-                    "uv",
-                    "pip",
-                    "install",
-                    "--prefix",
-                    str(self.deployment_path),
-                    "--python",
-                    python_path,
-                    *pypi_specs,
-                ],
-                check=True,
-                stdout=sp.PIPE,
-                stderr=sp.PIPE,
+        # Run uv as an asyncio subprocess, such that other deployments can proceed
+        # on the event loop while the pypi packages are installed.
+        cmd = [
+            "uv",
+            "pip",
+            "install",
+            "--prefix",
+            str(self.deployment_path),
+            "--python",
+            str(python_path),
+            *pypi_specs,
+        ]
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stdout, stderr = await process.communicate()
+        if process.returncode != 0:
+            e = sp.CalledProcessError(
+                process.returncode, cmd, output=stdout, stderr=stderr
+            )
+            raise WorkflowError(
+                f"Failed to install pypi packages: {stderr.decode(errors='replace')}",
+                e,
             )
-        except sp.CalledProcessError as e:
-            raise WorkflowError(f"Failed to install pypi packages: {e.stderr}", e)
 
     def is_deployment_path_portable(self) -> bool:
         # Deployment isn't portable because RPATHs are hardcoded as absolute paths by
@@ -547,4 +687,58 @@ class Env(PinnableEnvBase, CacheableEnvBase, DeployableEnvBase, EnvBase):
 
 
 def record_to_asset_name(record: RepoDataRecord) -> str:
-    return record.url.split("/")[-1]
+    return record.url.rpartition("/")[2]
+
+
+# The http client and the download semaphore are bound to the event loop they
+# are used in, hence keep one download session per loop.
+_DOWNLOAD_SESSIONS: "WeakKeyDictionary[asyncio.AbstractEventLoop, DownloadSession]" = (
+    WeakKeyDictionary()
+)
+
+
+class DownloadSession:
+    def __init__(self) -> None:
+        self.http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=16, max_keepalive_connections=16),
+        )
+        self.slots = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+        self._closer = self._close_on_loop_shutdown()
+
+    async def _close_on_loop_shutdown(self) -> AsyncGenerator[None, None]:
+        # Pending async generators are finalized by loop.shutdown_asyncgens()
+        # (called by asyncio.run before closing the loop), which closes the client.
+        try:
+            yield
+        finally:
+            _DOWNLOAD_SESSIONS.pop(asyncio.get_running_loop(), None)
+            await self.http_client.aclose()
+
+
+async def download_session() -> DownloadSession:
+    loop = asyncio.get_running_loop()
+    session = _DOWNLOAD_SESSIONS.get(loop)
+    if session is None:
+        session = _DOWNLOAD_SESSIONS[loop] = DownloadSession()
+        # register the closer with the running loop
+        await session._closer.__anext__()
+    return session
+
+
+@lru_cache(maxsize=1)
+def shared_gateway() -> Gateway:
+    # One gateway for all environments, such that repodata of channels they have
+    # in common is fetched and parsed only once per process.
+    return Gateway()
+
+
+@lru_cache(maxsize=1)
+def detect_virtual_packages() -> List[VirtualPackage]:
+    # The virtual packages of the host do not change while we are running.
+    return VirtualPackage.detect()
+
+
+def file_digest(path: Path, algorithm: str) -> bytes:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, algorithm).digest()
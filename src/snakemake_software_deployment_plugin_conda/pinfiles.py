@@ -5,11 +5,12 @@ from rattler.match_spec import MatchSpec
 
 def get_match_specs_from_conda_pinfile(path: Path) -> Generator[MatchSpec, None, None]:
     """Open given conda pinfile and yield its entries as rattler match spec strings."""
-    with open(path, "r") as f:
-        header = True
-        for record in f:
-            if header:
-                if record.strip() == "@EXPLICIT":
-                    header = False
-            else:
-                yield MatchSpec.from_url(record.strip())
+    lines = [line.strip() for line in path.read_text().splitlines()]
+    try:
+        start = lines.index("@EXPLICIT") + 1
+    except ValueError:
+        # no @EXPLICIT header, hence no entries
+        return
+    for record in lines[start:]:
+        if record:
+            yield MatchSpec.from_url(record)
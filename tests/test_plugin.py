@@ -1,6 +1,15 @@
+import asyncio
+import hashlib
 import os
+import shutil
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 from typing import Optional, Type
+
+import pytest
+from rattler import PackageRecord, RepoDataRecord
+from snakemake_interface_common.exceptions import WorkflowError
 from snakemake_interface_software_deployment_plugins.tests import (
     TestSoftwareDeploymentBase,
     ShellExecutable,
@@ -13,6 +22,9 @@ from snakemake_interface_software_deployment_plugins import (
 from snakemake_interface_software_deployment_plugins.settings import (
     SoftwareDeploymentSettingsBase,
 )
+from snakemake_software_deployment_plugin_conda.pinfiles import (
+    get_match_specs_from_conda_pinfile,
+)
 from snakemake_software_deployment_plugin_conda import (
     Env,
     EnvSpec,
@@ -21,6 +33,8 @@ from snakemake_software_deployment_plugin_container import Env as ContainerEnv
 from snakemake_software_deployment_plugin_container import EnvSpec as ContainerEnvSpec
 from snakemake_software_deployment_plugin_container import Settings as ContainerSettings
 
+TEST_DIR = Path(__file__).parent
+
 
 # There can be multiple subclasses of SoftwareDeploymentProviderBase here.
 # This way, you can implement multiple test scenarios.
@@ -34,9 +48,7 @@ class Test(TestSoftwareDeploymentBase):
         return "stress-ng"
 
     def get_env_spec(self) -> EnvSpecBase:
-        return EnvSpec(
-            envfile=EnvSpecSourceFile(Path(__file__).parent / "test_env.yaml")
-        )
+        return EnvSpec(envfile=EnvSpecSourceFile(TEST_DIR / "test_env.yaml"))
 
     def get_env_cls(self) -> Type[EnvBase]:
         # Return the environment class that should be tested.
@@ -63,27 +75,33 @@ class TestPinned(Test):
     __test__ = True
 
     def get_env_spec(self) -> EnvSpecBase:
-        return EnvSpec(
-            envfile=EnvSpecSourceFile(Path(__file__).parent / "test_env_pinned.yaml")
-        )
+        return EnvSpec(envfile=EnvSpecSourceFile(TEST_DIR / "test_env_pinned.yaml"))
+
+    def get_test_cmd(self) -> str:
+        # Test already runs stress-ng, here it suffices to check that the
+        # executable from the environment can be invoked.
+        return "stress-ng --version"
 
 
 class TestPypi(Test):
     __test__ = True
 
     def get_env_spec(self) -> EnvSpecBase:
-        return EnvSpec(
-            envfile=EnvSpecSourceFile(Path(__file__).parent / "test_env_pypi.yaml")
-        )
+        return EnvSpec(envfile=EnvSpecSourceFile(TEST_DIR / "test_env_pypi.yaml"))
 
     def get_test_cmd(self) -> str:
         # Return a test command that should be executed within the environment
         # with exit code 0 (i.e. without error).
-        return "which python; python -c 'import humanfriendly'"
+        return "python -c 'import humanfriendly'"
+
+
+# The container tests use the default udocker runtime of the container plugin.
+# Without it, they could only fail after trying to pull the image.
+HAS_UDOCKER = shutil.which("udocker") is not None
 
 
 class TestWithinContainer(Test):
-    __test__ = True
+    __test__ = HAS_UDOCKER
     # Do not use login shell here, we don't need an external conda but rather the udocker installed by pixi.
     shell_executable = ShellExecutable("bash", args=[], command_arg="-c")
 
@@ -96,9 +114,12 @@ class TestWithinContainer(Test):
     def get_within_settings(self) -> Optional[SoftwareDeploymentSettingsBase]:
         return ContainerSettings()
 
+    def get_test_cmd(self) -> str:
+        return "stress-ng --version"
+
 
 class TestPypiWithinContainer(TestPypi):
-    __test__ = True
+    __test__ = HAS_UDOCKER
     # Do not use login shell here, we don't need an external conda but rather the udocker installed by pixi.
     shell_executable = ShellExecutable("bash", args=[], command_arg="-c")
 
@@ -119,9 +140,7 @@ class TestNamed(Test):
         return EnvSpec(name="test-env")
 
     def get_test_cmd(self) -> str:
-        # Return a test command that should be executed within the environment
-        # with exit code 0 (i.e. without error).
-        return "stress-ng --cpu 1 --timeout 1s"
+        return "stress-ng --version"
 
 
 class TestDirectory(Test):
@@ -131,6 +150,144 @@ class TestDirectory(Test):
         return EnvSpec(directory=Path(os.environ["TEST_ENV_DIR"]))
 
     def get_test_cmd(self) -> str:
-        # Return a test command that should be executed within the environment
-        # with exit code 0 (i.e. without error).
-        return "stress-ng --cpu 1 --timeout 1s"
+        return "stress-ng --version"
+
+
+# Offline tests for the package download in Env.cache_asset, using a local
+# HTTP server instead of the conda channels.
+PACKAGE_NAME = "pkg-1.0-0.conda"
+PACKAGE_CONTENT = b"not really a conda package"
+
+
+@pytest.fixture
+def package_url(tmp_path):
+    served = tmp_path / "served"
+    served.mkdir()
+    (served / PACKAGE_NAME).write_bytes(PACKAGE_CONTENT)
+
+    class Handler(SimpleHTTPRequestHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=str(served), **kwargs)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/{PACKAGE_NAME}"
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def get_env_with_package(
+    tmp_path, url: str, sha256: Optional[bytes] = None, md5: Optional[bytes] = None
+) -> Env:
+    prefixes = {}
+    for name in ("temp", "deployments", "cache", "pinfiles"):
+        prefixes[name] = tmp_path / name
+        prefixes[name].mkdir()
+    env = Env(
+        spec=EnvSpec(envfile=EnvSpecSourceFile(TEST_DIR / "test_env.yaml")),
+        settings=None,
+        shell_executable=Test.shell_executable,
+        tempdir=prefixes["temp"],
+        mountpoints=[],
+        envvars=set(),
+        deployment_prefix=prefixes["deployments"],
+        cache_prefix=prefixes["cache"],
+        pinfile_prefix=prefixes["pinfiles"],
+        within=None,
+    )
+    # Pretend that the environment has been solved to the given package.
+    package_record = PackageRecord(
+        name="pkg",
+        version="1.0",
+        build="0",
+        build_number=0,
+        subdir="linux-64",
+        sha256=sha256,
+        md5=md5,
+    )
+    env._package_records_cache = [
+        RepoDataRecord(
+            package_record, PACKAGE_NAME, url, "https://conda.anaconda.org/conda-forge"
+        )
+    ]
+    return env
+
+
+def cache_assets(env: Env) -> None:
+    async def cache() -> None:
+        for asset in await env.get_cache_assets():
+            await env.managed_cache_asset(asset)
+
+    asyncio.run(cache())
+
+
+def test_cache_asset_download(tmp_path, package_url):
+    env = get_env_with_package(
+        tmp_path, package_url, sha256=hashlib.sha256(PACKAGE_CONTENT).digest()
+    )
+    cache_assets(env)
+    assert (env.cache_path / PACKAGE_NAME).read_bytes() == PACKAGE_CONTENT
+    assert not list(env.cache_path.glob("*.part"))
+
+
+def test_cache_asset_checksum_mismatch(tmp_path, package_url):
+    env = get_env_with_package(
+        tmp_path, package_url, sha256=hashlib.sha256(b"other").digest()
+    )
+    with pytest.raises(WorkflowError, match="Checksum mismatch"):
+        cache_assets(env)
+    assert not (env.cache_path / PACKAGE_NAME).exists()
+    assert not list(env.cache_path.glob("*.part"))
+
+
+def test_cache_asset_md5_mismatch(tmp_path, package_url):
+    # Records without sha256 are verified via their md5.
+    env = get_env_with_package(
+        tmp_path, package_url, md5=hashlib.md5(b"other").digest()
+    )
+    with pytest.raises(WorkflowError, match="expected md5"):
+        cache_assets(env)
+    assert not (env.cache_path / PACKAGE_NAME).exists()
+    assert not list(env.cache_path.glob("*.part"))
+
+
+def test_cache_asset_reuses_intact_copy(tmp_path, package_url):
+    # The url does not exist on the server, hence the asset can only be obtained
+    # from the already cached copy.
+    env = get_env_with_package(
+        tmp_path,
+        package_url.replace(PACKAGE_NAME, f"missing/{PACKAGE_NAME}"),
+        sha256=hashlib.sha256(PACKAGE_CONTENT).digest(),
+    )
+    cached = env.cache_path / PACKAGE_NAME
+    cached.write_bytes(PACKAGE_CONTENT)
+    inode = cached.stat().st_ino
+    cache_assets(env)
+    assert cached.read_bytes() == PACKAGE_CONTENT
+    # the intact copy is moved around instead of being copied
+    assert cached.stat().st_ino == inode
+    assert not list(env.cache_path.glob("*.part"))
+
+
+PINFILE_URL = "https://conda.anaconda.org/conda-forge/linux-64/pkg-1.0-0.conda"
+
+
+def test_pinfile_with_platform_comment_and_trailing_blank_lines(tmp_path):
+    pinfile = tmp_path / "env.linux-64.pin.txt"
+    pinfile.write_text(
+        f"# platform: linux-64\n@EXPLICIT\n{PINFILE_URL}\n{PINFILE_URL}#{'0' * 32}\n\n\n"
+    )
+    specs = list(get_match_specs_from_conda_pinfile(pinfile))
+    assert len(specs) == 2
+    assert all(spec.name.normalized == "pkg" for spec in specs)
+
+
+def test_pinfile_without_explicit_header(tmp_path):
+    pinfile = tmp_path / "env.linux-64.pin.txt"
+    pinfile.write_text(f"# platform: linux-64\n{PINFILE_URL}\n")
+    assert list(get_match_specs_from_conda_pinfile(pinfile)) == []